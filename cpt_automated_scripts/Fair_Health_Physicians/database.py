@@ -1,21 +1,99 @@
 import logging
 from supabase import create_client, Client
-from typing import List, Dict
+from postgrest import APIError
+from postgrest.types import ReturnMethod
+from typing import Callable, List, Dict, Optional, Tuple, TypeVar
 import os
 from dotenv import load_dotenv
 from datetime import datetime
+from functools import lru_cache
+import atexit
+import httpx
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import random
+import time
 
 logger = logging.getLogger(__name__)
+T = TypeVar("T")
+
+@lru_cache(maxsize=1)
+def _bootstrap_env() -> Tuple[Optional[str], Optional[str]]:
+    """Load the .env file once per process and return (SUPABASE_URL, SUPABASE_KEY)"""
+    load_dotenv()
+    return os.getenv("SUPABASE_URL"), os.getenv("SUPABASE_KEY")
+
+_bootstrap_env()
+
+try:
+    import h2  # noqa: F401 - enables HTTP/2 in httpx
+    _HTTP2 = True
+except ImportError:
+    _HTTP2 = False
+
+# Rows per insert request; keeps each PostgREST body well under request-size limits
+BATCH_SIZE = int(os.getenv("SUPABASE_INSERT_BATCH", "1000"))
+# Batch inserts in flight at once
+INSERT_CONCURRENCY = int(os.getenv("SUPABASE_INSERT_CONCURRENCY", "6"))
+# Background writer for logging_table; its threads are joined at interpreter exit
+_LOG_POOL = ThreadPoolExecutor(max_workers=2, thread_name_prefix="supabase-log")
+
+def _chunked(records: List[Dict], size: int):
+    """Yield consecutive slices of at most `size` records"""
+    for i in range(0, len(records), size):
+        yield records[i:i + size]
+
+# Error codes for failures where the request was rejected before anything was
+# committed, so repeating it can't double-archive or double-insert: connection
+# loss (08xxx), serialization failure / deadlock, too many connections, database
+# starting up, PostgREST unable to reach the database, and gateway 503s
+_TRANSIENT_DB_CODES = {"40001", "40P01", "53300", "57P03", "PGRST000", "PGRST001", "PGRST002", "PGRST003", "503"}
+
+def _is_transient(error: Exception) -> bool:
+    """True if the failed call provably had no effect and is worth retrying"""
+    if isinstance(error, APIError):
+        code = str(error.code or "")
+        return code in _TRANSIENT_DB_CODES or code.startswith("08")
+    # Timeouts after the request was sent are not retried: it may have been applied
+    return isinstance(error, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout))
+
+def retry_db(fn: Callable[[], T], *, retries: int = 6, base: float = 0.2, cap: float = 10.0) -> T:
+    """Call fn(), retrying transient database failures with jittered exponential backoff"""
+    for attempt in range(retries):
+        try:
+            return fn()
+        except (APIError, httpx.TransportError) as e:
+            if not _is_transient(e) or attempt == retries - 1:
+                raise
+            delay = min(cap, base * 2 ** attempt) + random.random() * base
+            logger.warning(f"⚠️ Transient database error ({e}); retrying in {delay:.1f}s...")
+            time.sleep(delay)
+
+@lru_cache(maxsize=1)
+def get_client() -> Client:
+    """Return the Supabase client shared by every handler in this process"""
+    client = create_client(*_bootstrap_env())
+
+    # Swap the default PostgREST session for one with a larger keep-alive pool and
+    # explicit timeouts, so the concurrent batch inserts never queue for a socket
+    default_session = client.postgrest.session
+    client.postgrest.session = type(default_session)(
+        base_url=default_session.base_url,
+        headers=default_session.headers,
+        limits=httpx.Limits(max_connections=60, max_keepalive_connections=40, keepalive_expiry=60),
+        timeout=httpx.Timeout(60.0, connect=10.0),
+        follow_redirects=True,
+        http2=_HTTP2,
+    )
+    default_session.close()
+    atexit.register(client.postgrest.session.close)
+    return client
 
 class SupabaseHandlerPhysician:
     """Handle Supabase operations for Fair Health Physician data with historical archival"""
     
     def __init__(self):
         """Initialize Supabase client and configuration"""
-        load_dotenv()
-        
-        self.supabase_url = os.getenv("SUPABASE_URL")
-        self.supabase_key = os.getenv("SUPABASE_KEY")
+        self.supabase_url, self.supabase_key = _bootstrap_env()
         
         # --- Table Configuration ---
         self.updated_table = "updated_medical_benchmarking_data"
@@ -31,7 +109,7 @@ class SupabaseHandlerPhysician:
             raise ValueError("SUPABASE_URL and SUPABASE_KEY must be set in environment variables")
         
         try:
-            self.client: Client = create_client(self.supabase_url, self.supabase_key)
+            self.client: Client = get_client()
             logger.info(f"✅ Supabase client initialized for table: {self.updated_table}")
         except Exception as e:
             logger.error(f"❌ Failed to initialize Supabase client: {e}")
@@ -40,10 +118,13 @@ class SupabaseHandlerPhysician:
     def insert_records(self, records: List[Dict]) -> Dict:
         """
         Complete pipeline for FairHealth Physician:
-        1. Query existing records for BOTH data_types
-        2. Archive them to historical table
-        3. Delete them from updated table
-        4. Insert new records
+        1. Archive existing records for BOTH data_types to historical table
+        2. Delete them from updated table
+        3. Insert the first batch of new records (1-3 run as one server-side transaction)
+        4. Insert the remaining new records
+           (each batch commits on its own and is retried on transient errors; a batch
+           that still fails leaves a partial load in updated_table, which the next
+           run archives as if it were a full snapshot)
         5. Log the operation
         """
         if not records:
@@ -60,53 +141,31 @@ class SupabaseHandlerPhysician:
         logger.info(f"   Target data_types: {self.data_types}")
         
         try:
-            # ===== STEP 1: Query existing records =====
-            logger.info(f"📥 STEP 1: Querying existing records for target data_types...")
+            # ===== STEPS 1-3: Archive, delete and load first batch server-side =====
+            logger.info(f"📦 STEPS 1-3: Archiving and replacing existing records...")
             
-            # Use .in_() to find records matching either Physician USA or Physician 070
-            existing_response = self.client.table(self.updated_table)\
-                .select("*")\
-                .in_("data_type", self.data_types)\
-                .execute()
+            # Single transaction, so a failure can't leave rows archived but not deleted.
+            # Only the first batch shares it; later batches commit separately (see STEP 4)
+            result = retry_db(lambda: self.client.rpc(
+                "archive_and_replace",
+                {"p_data_types": self.data_types, "p_new": records[:BATCH_SIZE]}
+            ).execute()).data
             
-            existing_records = existing_response.data
-            records_to_archive = len(existing_records)
-            logger.info(f"   Found {records_to_archive} existing records to archive")
-            
-            # ===== STEP 2: Archive to historical =====
+            records_to_archive = result["archived"]
+            inserted_count = result["inserted"]
             if records_to_archive > 0:
-                logger.info(f"📦 STEP 2: Archiving {records_to_archive} records...")
-                
-                # Remove 'id' to allow new UUID generation in history table
-                records_for_history = []
-                for record in existing_records:
-                    historical_record = {k: v for k, v in record.items() if k != 'id'}
-                    records_for_history.append(historical_record)
-                
-                self.client.table(self.historical_table).insert(records_for_history).execute()
-                logger.info(f"   ✅ Archived records")
+                logger.info(f"   ✅ Archived and deleted {records_to_archive} existing records")
             else:
                 logger.info("   ℹ️ No existing records to archive")
             
-            # ===== STEP 3: Delete old records =====
-            if records_to_archive > 0:
-                logger.info(f"🗑️ STEP 3: Deleting old records...")
-                
-                # Delete all records matching the data types
-                self.client.table(self.updated_table)\
-                    .delete()\
-                    .in_("data_type", self.data_types)\
-                    .execute()
-                
-                logger.info(f"   ✅ Deleted old records")
-                
-            # ===== STEP 4: Insert new records =====
+            # ===== STEP 4: Insert remaining new records =====
             records_to_insert = len(records)
             logger.info(f"📤 STEP 4: Inserting {records_to_insert} new records...")
             
-            response = self.client.table(self.updated_table).insert(records).execute()
-            
-            inserted_count = len(response.data) if response.data else 0
+            # The first batch went in with the RPC; the rest follow as concurrent batches.
+            # These commit after the archive, so a batch that fails after retries leaves
+            # updated_table half-loaded until the next successful run
+            inserted_count += self._insert_batches(self.updated_table, records[BATCH_SIZE:])
             logger.info(f"   ✅ Successfully inserted {inserted_count} records")
             
             # ===== STEP 5: Log operation =====
@@ -129,6 +188,23 @@ class SupabaseHandlerPhysician:
             self._log_operation(f"FAILED: {error_msg}", success=False)
             raise
 
+    def _insert_batches(self, table: str, records: List[Dict]) -> int:
+        """Insert records into `table` in concurrent batches, returning the number inserted"""
+        def insert_batch(batch: List[Dict]) -> int:
+            # return=minimal: PostgREST doesn't echo the rows back; a batch either lands whole or raises
+            retry_db(lambda: self.client.table(table).insert(batch, returning=ReturnMethod.minimal).execute())
+            return len(batch)
+
+        with ThreadPoolExecutor(max_workers=INSERT_CONCURRENCY) as executor:
+            futures = [executor.submit(insert_batch, batch) for batch in _chunked(records, BATCH_SIZE)]
+            try:
+                return sum(future.result() for future in as_completed(futures))
+            except Exception:
+                # Don't start batches still waiting in the queue once one has failed
+                for future in futures:
+                    future.cancel()
+                raise
+
     def _create_log_message(self, archived_count: int, inserted_count: int) -> str:
         """Create a human-readable log message"""
         timestamp = datetime.now().strftime("%B %d, %Y at %I:%M %p")
@@ -141,6 +217,10 @@ class SupabaseHandlerPhysician:
                     f"({timestamp})")
 
     def _log_operation(self, message: str, success: bool = True):
+        """Queue the logging_table write in the background; nothing waits on its result"""
+        _LOG_POOL.submit(self._write_log, message, success)
+
+    def _write_log(self, message: str, success: bool = True):
         """
         Log to logging_table.
         Schema: (id, created_at, message, script)
@@ -151,7 +231,7 @@ class SupabaseHandlerPhysician:
                 "message": message
             }
             
-            self.client.table(self.logging_table).insert(log_entry).execute()
+            retry_db(lambda: self.client.table(self.logging_table).insert(log_entry, returning=ReturnMethod.minimal).execute())
             
             status_icon = "✅" if success else "❌"
             logger.info(f"{status_icon} Logged to DB: {message}")
@@ -1,3 +1,4 @@
+import re
 import pandas as pd
 from pathlib import Path
 import logging
@@ -5,6 +6,13 @@ import numpy as np
 
 logger = logging.getLogger(__name__)
 
+# calamine parses XLSX/XLS several times faster than openpyxl; use it when installed
+try:
+    import python_calamine  # noqa: F401
+    EXCEL_ENGINE = "calamine"
+except ImportError:
+    EXCEL_ENGINE = None  # pandas' default reader
+
 class DataProcessorASC:
     """Process and clean the downloaded ASC Addendum B file"""
 
@@ -22,26 +30,30 @@ class DataProcessorASC:
 
         try:
             # Load the file without a header first to find the real one
-            df_temp = pd.read_excel(file_path, header=None)
-            
-            header_row_idx = None
-            
-            # Find the header row by searching for key columns
-            for idx, row in df_temp.iterrows():
-                row_str = " ".join(row.astype(str).fillna("")).upper()
-                if (self.SOURCE_HCPCS_COL.upper() in row_str and 
-                    self.SOURCE_DESC_COL.upper() in row_str):
-                    
-                    header_row_idx = idx 
-                    logger.info(f"✅ Found header row at index: {header_row_idx}")
-                    break
+            df_temp = pd.read_excel(file_path, header=None, engine=EXCEL_ENGINE)
             
+            # Find the header row by searching every row's text for the key columns at once
+            row_text = df_temp.astype(str).fillna("").agg(" ".join, axis=1).str.upper()
+            is_header = (row_text.str.contains(self.SOURCE_HCPCS_COL.upper(), regex=False) &
+                         row_text.str.contains(self.SOURCE_DESC_COL.upper(), regex=False))
+            header_row_idx = is_header.idxmax() if is_header.any() else None
+
             if header_row_idx is None:
                 raise ValueError(f"Could not find header row with '{self.SOURCE_HCPCS_COL}' and '{self.SOURCE_DESC_COL}'")
+            logger.info(f"✅ Found header row at index: {header_row_idx}")
+
+            # Keep only the columns clean_data maps (code, descriptor, payment rate)
+            header = df_temp.iloc[header_row_idx].astype(str)
+            markers = [self.SOURCE_HCPCS_COL, self.SOURCE_DESC_COL, self.SOURCE_RATE_MARKER]
+            wanted = header.str.lower().str.contains("|".join(re.escape(m.lower()) for m in markers))
+
+            # Slice the data out of the sheet we already parsed instead of reading the file again
+            df = df_temp.iloc[header_row_idx + 1:, wanted.to_numpy()].copy()
+            df.columns = header[wanted].tolist()
+            df.reset_index(drop=True, inplace=True)
+            # The header rows above kept every column as object; restore per-column dtypes
+            df = df.infer_objects()
 
-            # Now, read the file again using the correct header row
-            df = pd.read_excel(file_path, header=header_row_idx)
-            
             logger.info(f"✅ Loaded {len(df)} rows (raw)")
             logger.info(f"📋 Raw columns found: {list(df.columns)}")
             return df
@@ -57,17 +69,23 @@ class DataProcessorASC:
         # --- Find and map columns ---
         columns_mapping = {}
         available_columns = df.columns.astype(str)
+        # Lower-case the header once and match every marker against it
+        lower_cols = available_columns.str.lower()
+
+        def find_column(marker: str):
+            matches = lower_cols.str.contains(marker.lower(), regex=False)
+            return available_columns[matches.argmax()] if matches.any() else None
         
         # Find HCPCS Code
-        hcpcs_col = next((col for col in available_columns if self.SOURCE_HCPCS_COL.lower() in col.lower()), None)
+        hcpcs_col = find_column(self.SOURCE_HCPCS_COL)
         if hcpcs_col: columns_mapping['code'] = hcpcs_col
 
         # Find Short Descriptor
-        desc_col = next((col for col in available_columns if self.SOURCE_DESC_COL.lower() in col.lower()), None)
+        desc_col = find_column(self.SOURCE_DESC_COL)
         if desc_col: columns_mapping['code_description'] = desc_col
         
         # --- MODIFIED LOGIC: Find Payment Rate column generically ---
-        rate_col_name = next((col for col in available_columns if self.SOURCE_RATE_MARKER.lower() in col.lower()), None)
+        rate_col_name = find_column(self.SOURCE_RATE_MARKER)
         if rate_col_name: 
             columns_mapping['80th'] = rate_col_name
             logger.info(f"✅ Found Payment Rate column: '{rate_col_name}'")
@@ -98,8 +116,10 @@ class DataProcessorASC:
         logger.info(f"➕ Adding 'rel_date' column with value: {rel_date_value}")
         df_cleaned['rel_date'] = rel_date_value
     
-        df_cleaned = df_cleaned.dropna(subset=["code"])
-        df_cleaned = df_cleaned[df_cleaned["code"].astype(str).str.strip().str.len() > 0]
+        # Drop missing/blank codes in one pass and keep the stripped code for later steps
+        code_str = df_cleaned["code"].astype("string").str.strip()
+        keep = code_str.notna() & (code_str.str.len() > 0)
+        df_cleaned = df_cleaned.loc[keep].assign(code=code_str[keep])
 
         logger.info("🔢 Converting '80th' column to numeric...")
         
@@ -108,15 +128,11 @@ class DataProcessorASC:
         
 
         logger.info("🔧 Converting ALL NaN values to None for JSON compliance...")
-        
-        for col in df_cleaned.columns:
-            # Check if the column has any nulls (NaN or NaT)
-            if df_cleaned[col].isnull().any():
-                logger.info(f"    -> Fixing NaNs in column '{col}'")
-                # Apply the robust fix: convert to object, replace NaN/NaT with None
-                df_cleaned[col] = df_cleaned[col].astype(object).where(pd.notnull(df_cleaned[col]), None)
-    
-        df_cleaned = df_cleaned.dropna(how="all")
+
+        # One whole-frame pass: convert to object, replace NaN/NaT with None
+        df_cleaned = df_cleaned.astype(object).where(pd.notnull(df_cleaned), None)
+
+        # No all-null rows can remain: every row has a code, data_type and rel_date
         df_cleaned.reset_index(drop=True, inplace=True)
 
         logger.info(f"✅ Cleaned data: {len(df_cleaned)} rows remaining")
@@ -1,20 +1,99 @@
 from supabase import create_client, Client
-from typing import List, Dict
+from postgrest import APIError
+from postgrest.types import ReturnMethod
+from typing import Callable, List, Dict, Optional, Tuple, TypeVar
 import logging
 import os
 import dotenv
 from datetime import datetime
+from functools import lru_cache
+import atexit
+import httpx
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import random
+import time
 
 logger = logging.getLogger(__name__)
-dotenv.load_dotenv()
+T = TypeVar("T")
+
+@lru_cache(maxsize=1)
+def _bootstrap_env() -> Tuple[Optional[str], Optional[str]]:
+    """Load the .env file once per process and return (SUPABASE_URL, SUPABASE_KEY)"""
+    dotenv.load_dotenv()
+    return os.getenv("SUPABASE_URL"), os.getenv("SUPABASE_KEY")
+
+_bootstrap_env()
+
+try:
+    import h2  # noqa: F401 - enables HTTP/2 in httpx
+    _HTTP2 = True
+except ImportError:
+    _HTTP2 = False
+
+# Rows per insert request; keeps each PostgREST body well under request-size limits
+BATCH_SIZE = int(os.getenv("SUPABASE_INSERT_BATCH", "1000"))
+# Batch inserts in flight at once
+INSERT_CONCURRENCY = int(os.getenv("SUPABASE_INSERT_CONCURRENCY", "6"))
+# Background writer for logging_table; its threads are joined at interpreter exit
+_LOG_POOL = ThreadPoolExecutor(max_workers=2, thread_name_prefix="supabase-log")
+
+def _chunked(records: List[Dict], size: int):
+    """Yield consecutive slices of at most `size` records"""
+    for i in range(0, len(records), size):
+        yield records[i:i + size]
+
+# Error codes for failures where the request was rejected before anything was
+# committed, so repeating it can't double-archive or double-insert: connection
+# loss (08xxx), serialization failure / deadlock, too many connections, database
+# starting up, PostgREST unable to reach the database, and gateway 503s
+_TRANSIENT_DB_CODES = {"40001", "40P01", "53300", "57P03", "PGRST000", "PGRST001", "PGRST002", "PGRST003", "503"}
+
+def _is_transient(error: Exception) -> bool:
+    """True if the failed call provably had no effect and is worth retrying"""
+    if isinstance(error, APIError):
+        code = str(error.code or "")
+        return code in _TRANSIENT_DB_CODES or code.startswith("08")
+    # Timeouts after the request was sent are not retried: it may have been applied
+    return isinstance(error, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout))
+
+def retry_db(fn: Callable[[], T], *, retries: int = 6, base: float = 0.2, cap: float = 10.0) -> T:
+    """Call fn(), retrying transient database failures with jittered exponential backoff"""
+    for attempt in range(retries):
+        try:
+            return fn()
+        except (APIError, httpx.TransportError) as e:
+            if not _is_transient(e) or attempt == retries - 1:
+                raise
+            delay = min(cap, base * 2 ** attempt) + random.random() * base
+            logger.warning(f"⚠️ Transient database error ({e}); retrying in {delay:.1f}s...")
+            time.sleep(delay)
+
+@lru_cache(maxsize=1)
+def get_client() -> Client:
+    """Return the Supabase client shared by every handler in this process"""
+    client = create_client(*_bootstrap_env())
+
+    # Swap the default PostgREST session for one with a larger keep-alive pool and
+    # explicit timeouts, so the concurrent batch inserts never queue for a socket
+    default_session = client.postgrest.session
+    client.postgrest.session = type(default_session)(
+        base_url=default_session.base_url,
+        headers=default_session.headers,
+        limits=httpx.Limits(max_connections=60, max_keepalive_connections=40, keepalive_expiry=60),
+        timeout=httpx.Timeout(60.0, connect=10.0),
+        follow_redirects=True,
+        http2=_HTTP2,
+    )
+    default_session.close()
+    atexit.register(client.postgrest.session.close)
+    return client
 
 class SupabaseHandlerCLFS:
     """Handle Supabase database operations for the CLFS table with historical archival"""
     
     def __init__(self):
         # Load from environment variables
-        self.supabase_url = os.getenv("SUPABASE_URL")
-        self.supabase_key = os.getenv("SUPABASE_KEY")
+        self.supabase_url, self.supabase_key = _bootstrap_env()
         
         # Table names
         self.updated_table = "updated_medical_benchmarking_data"
@@ -23,14 +102,14 @@ class SupabaseHandlerCLFS:
         
         # Script configuration
         self.script_name = "Medicare Clinical Fees"
-        self.data_type = "Medicare Lab"
+        self.data_types = ["Medicare Lab"]
         
         if not self.supabase_url or not self.supabase_key:
             logger.error("❌ Missing Supabase credentials. Set SUPABASE_URL and SUPABASE_KEY in .env file.")
             raise ValueError("Missing Supabase credentials in environment variables")
         
         try:
-            self.client: Client = create_client(self.supabase_url, self.supabase_key)
+            self.client: Client = get_client()
             logger.info(f"✅ Supabase client initialized for table: '{self.updated_table}'")
         except Exception as e:
             logger.error(f"Failed to initialize Supabase client: {e}")
@@ -39,10 +118,13 @@ class SupabaseHandlerCLFS:
     def insert_records(self, records: List[Dict]) -> dict:
         """
         Complete pipeline with historical archival:
-        1. Query existing records by data_type from updated_table
-        2. Insert those records into historical_table (archive)
-        3. Delete those records from updated_table
-        4. Insert new cleaned records into updated_table
+        1. Copy existing records for data_types from updated_table into historical_table
+        2. Delete those records from updated_table
+        3. Insert the first batch of new records (1-3 run as one server-side transaction)
+        4. Insert the remaining new cleaned records into updated_table
+           (each batch commits on its own and is retried on transient errors; a batch
+           that still fails leaves a partial load in updated_table, which the next
+           run archives as if it were a full snapshot)
         5. Log the operation
         
         Returns: Summary of insertion results
@@ -59,54 +141,33 @@ class SupabaseHandlerCLFS:
             
         logger.info(f"🚀 Starting pipeline for '{self.script_name}'...")
         logger.info(f"   Processing {len(records)} new records")
-        logger.info(f"   Target data_type: '{self.data_type}'")
+        logger.info(f"   Target data_types: {self.data_types}")
         
         try:
-            # ===== STEP 1: Query existing records from updated_table =====
-            logger.info(f"📥 STEP 1: Querying existing records with data_type='{self.data_type}'...")
-            
-            existing_response = self.client.table(self.updated_table)\
-                .select("*")\
-                .eq("data_type", self.data_type)\
-                .execute()
-            
-            existing_records = existing_response.data
-            records_to_archive = len(existing_records)
+            # ===== STEPS 1-3: Archive, delete and load first batch server-side =====
+            logger.info(f"📦 STEPS 1-3: Archiving and replacing existing records...")
             
-            logger.info(f"   Found {records_to_archive} existing records")
+            # Single transaction, so a failure can't leave rows archived but not deleted.
+            # Only the first batch shares it; later batches commit separately (see STEP 4)
+            result = retry_db(lambda: self.client.rpc(
+                "archive_and_replace",
+                {"p_data_types": self.data_types, "p_new": records[:BATCH_SIZE]}
+            ).execute()).data
             
-            # ===== STEP 2: Archive existing records to historical_table =====
+            records_to_archive = result["archived"]
             if records_to_archive > 0:
-                logger.info(f"📦 STEP 2: Archiving {records_to_archive} records to historical table...")
-                
-                # Remove 'id' field before inserting (let historical table generate new IDs)
-                records_for_history = []
-                for record in existing_records:
-                    historical_record = {k: v for k, v in record.items() if k != 'id'}
-                    records_for_history.append(historical_record)
-                
-                self.client.table(self.historical_table).insert(records_for_history).execute()
-                logger.info(f"   ✅ Archived {records_to_archive} records to historical table")
+                logger.info(f"   ✅ Archived and deleted {records_to_archive} existing records")
             else:
                 logger.info("   ℹ️ No existing records to archive (first run or fresh data)")
             
-            # ===== STEP 3: Delete old records from updated_table =====
-            if records_to_archive > 0:
-                logger.info(f"🗑️ STEP 3: Deleting {records_to_archive} old records from updated table...")
-                
-                self.client.table(self.updated_table)\
-                    .delete()\
-                    .eq("data_type", self.data_type)\
-                    .execute()
-                
-                logger.info(f"   ✅ Deleted {records_to_archive} old records")
-            
-            # ===== STEP 4: Insert new records into updated_table =====
+            # ===== STEP 4: Insert remaining new records =====
             records_to_insert = len(records)
             logger.info(f"📤 STEP 4: Inserting {records_to_insert} new records into updated table...")
             
-            response = self.client.table(self.updated_table).insert(records).execute()
-            
+            # The first batch went in with the RPC; the rest follow as concurrent batches.
+            # These commit after the archive, so a batch that fails after retries leaves
+            # updated_table half-loaded until the next successful run
+            self._insert_batches(self.updated_table, records[BATCH_SIZE:])
             logger.info(f"   ✅ Successfully inserted {records_to_insert} new records")
             
             # ===== STEP 5: Log the operation =====
@@ -132,6 +193,23 @@ class SupabaseHandlerCLFS:
             
             raise Exception(error_message)
     
+    def _insert_batches(self, table: str, records: List[Dict]) -> int:
+        """Insert records into `table` in concurrent batches, returning the number inserted"""
+        def insert_batch(batch: List[Dict]) -> int:
+            # return=minimal: PostgREST doesn't echo the rows back; a batch either lands whole or raises
+            retry_db(lambda: self.client.table(table).insert(batch, returning=ReturnMethod.minimal).execute())
+            return len(batch)
+
+        with ThreadPoolExecutor(max_workers=INSERT_CONCURRENCY) as executor:
+            futures = [executor.submit(insert_batch, batch) for batch in _chunked(records, BATCH_SIZE)]
+            try:
+                return sum(future.result() for future in as_completed(futures))
+            except Exception:
+                # Don't start batches still waiting in the queue once one has failed
+                for future in futures:
+                    future.cancel()
+                raise
+
     def _create_log_message(self, archived_count: int, inserted_count: int) -> str:
         """Create a human-readable log message"""
         timestamp = datetime.now().strftime("%B %d, %Y at %I:%M %p")
@@ -146,6 +224,10 @@ class SupabaseHandlerCLFS:
         return message
     
     def _log_operation(self, message: str, success: bool = True):
+        """Queue the logging_table write in the background; nothing waits on its result"""
+        _LOG_POOL.submit(self._write_log, message, success)
+
+    def _write_log(self, message: str, success: bool = True):
         """Log operation to logging_table"""
         try:
             log_entry = {
@@ -153,7 +235,7 @@ class SupabaseHandlerCLFS:
                 "script": self.script_name
             }
             
-            self.client.table(self.logging_table).insert(log_entry).execute()
+            retry_db(lambda: self.client.table(self.logging_table).insert(log_entry, returning=ReturnMethod.minimal).execute())
             
             status = "✅" if success else "❌"
             logger.info(f"{status} Logged to database: {message}")
@@ -1,20 +1,150 @@
+import io
 import os
 import logging
-from typing import List, Dict
+from typing import Callable, List, Dict, Optional, Tuple, TypeVar
 import dotenv
 from supabase import create_client, Client
+from postgrest.types import ReturnMethod
 from postgrest import APIError
+from collections import Counter
 from datetime import datetime
+from functools import lru_cache
+import atexit
+import httpx
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import random
+import time
 
 logger = logging.getLogger(__name__)
-dotenv.load_dotenv()
+T = TypeVar("T")
+
+@lru_cache(maxsize=1)
+def _bootstrap_env() -> Tuple[Optional[str], Optional[str]]:
+    """Load the .env file once per process and return (SUPABASE_URL, SUPABASE_KEY)"""
+    dotenv.load_dotenv()
+    return os.getenv("SUPABASE_URL"), os.getenv("SUPABASE_KEY")
+
+_bootstrap_env()
+
+try:
+    import orjson
+except ImportError:
+    orjson = None  # fall back to httpx's stdlib json encoding
+
+try:
+    import h2  # noqa: F401 - enables HTTP/2 in httpx
+    _HTTP2 = True
+except ImportError:
+    _HTTP2 = False
+
+try:
+    import psycopg2
+    from psycopg2 import sql
+except ImportError:
+    psycopg2 = None  # COPY fast path unavailable; load through PostgREST
+
+# Direct Postgres connection string; when set (and psycopg2 is installed) new
+# records are bulk-loaded with COPY instead of batched PostgREST inserts
+SUPABASE_DB_URL = os.getenv("SUPABASE_DB_URL")
+
+# Rows per insert request; bounds PostgREST's per-request memory and body size
+BATCH_SIZE = int(os.getenv("SUPABASE_INSERT_BATCH", "500"))
+# Batch inserts in flight at once
+INSERT_CONCURRENCY = int(os.getenv("SUPABASE_INSERT_CONCURRENCY", "8"))
+
+_MONTHS = ("January", "February", "March", "April", "May", "June", "July",
+           "August", "September", "October", "November", "December")
+
+def _chunked(records: List[Dict], size: int):
+    """Yield consecutive slices of at most `size` records"""
+    for i in range(0, len(records), size):
+        yield records[i:i + size]
+
+def _copy_value(value) -> str:
+    """Render one value as a field of COPY's text format"""
+    if value is None:
+        return "\\N"
+    return (str(value).replace("\\", "\\\\").replace("\t", "\\t")
+            .replace("\n", "\\n").replace("\r", "\\r"))
+
+# Error codes for failures where the request was rejected before anything was
+# committed, so repeating it can't double-archive or double-insert: connection
+# loss (08xxx), serialization failure / deadlock, too many connections, database
+# starting up, PostgREST unable to reach the database, and gateway 503s
+_TRANSIENT_DB_CODES = {"40001", "40P01", "53300", "57P03", "PGRST000", "PGRST001", "PGRST002", "PGRST003", "503"}
+
+def _is_transient(error: Exception) -> bool:
+    """True if the failed call provably had no effect and is worth retrying"""
+    if isinstance(error, APIError):
+        code = str(error.code or "")
+        return code in _TRANSIENT_DB_CODES or code.startswith("08")
+    # Timeouts after the request was sent are not retried: it may have been applied
+    return isinstance(error, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout))
+
+def retry_db(fn: Callable[[], T], *, retries: int = 6, base: float = 0.2, cap: float = 10.0) -> T:
+    """Call fn(), retrying transient database failures with jittered exponential backoff"""
+    for attempt in range(retries):
+        try:
+            return fn()
+        except (APIError, httpx.TransportError) as e:
+            if not _is_transient(e) or attempt == retries - 1:
+                raise
+            delay = min(cap, base * 2 ** attempt) + random.random() * base
+            logger.warning("⚠️ Transient database error (%s); retrying in %.1fs...", e, delay)
+            time.sleep(delay)
+
+class _OrjsonBodyMixin:
+    """httpx client mixin that encodes json= request bodies with orjson"""
+
+    def build_request(self, method, url, *, json=None, **kwargs):
+        if json is not None:
+            kwargs["content"] = orjson.dumps(json, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+            json = None
+            # httpx only sets Content-Type itself for json=; raw content goes out without one
+            headers = httpx.Headers(kwargs.get("headers"))
+            headers["Content-Type"] = "application/json"
+            kwargs["headers"] = headers
+        return super().build_request(method, url, json=json, **kwargs)
+
+@lru_cache(maxsize=1)
+def get_client() -> Client:
+    """Return the Supabase client shared by every handler in this process"""
+    client = create_client(*_bootstrap_env())
+
+    # Swap the default PostgREST session for one that keeps enough connections alive
+    # for the concurrent batch inserts (multiplexed over one connection on HTTP/2)
+    default_session = client.postgrest.session
+    session_class = type(default_session)
+    if orjson is not None:
+        # Insert and RPC bodies carry every record; encode them with orjson
+        session_class = type("OrjsonSession", (_OrjsonBodyMixin, session_class), {})
+    client.postgrest.session = session_class(
+        base_url=default_session.base_url,
+        headers=default_session.headers,
+        limits=httpx.Limits(max_connections=32, max_keepalive_connections=32, keepalive_expiry=60),
+        timeout=default_session.timeout,
+        follow_redirects=True,
+        http2=_HTTP2,
+    )
+    default_session.close()
+    atexit.register(client.postgrest.session.close)
+    return client
+
+@lru_cache(maxsize=1)
+def _warmup(client: Client, table: str) -> None:
+    """Probe `table` once per process so bad credentials or DNS fail at startup"""
+    # limit(0) returns no rows but still authenticates and opens the connection
+    client.table(table).select("id").limit(0).execute()
 
 class SupabaseHandler:
     """Handle Supabase database operations for NJ Medical PIP data with historical archival"""
     
+    # Writes logging_table rows in the background so the caller isn't held up by the request
+    _log_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="supabase-log")
+    atexit.register(_log_pool.shutdown)
+    
     def __init__(self):
-        self.supabase_url = os.getenv("SUPABASE_URL")
-        self.supabase_key = os.getenv("SUPABASE_KEY")
+        self.supabase_url, self.supabase_key = _bootstrap_env()
         
         # Table names
         self.updated_table = "updated_medical_benchmarking_data"
@@ -30,20 +160,25 @@ class SupabaseHandler:
             raise ValueError("Missing Supabase credentials in environment variables")
         
         try:
-            self.client: Client = create_client(self.supabase_url, self.supabase_key)
-            logger.info(f"✅ Supabase client initialized for table: '{self.updated_table}'")
+            self.client: Client = get_client()
+            _warmup(self.client, self.updated_table)
+            logger.info("✅ Supabase client initialized for table: '%s'", self.updated_table)
         except Exception as e:
-            logger.error(f"Failed to initialize Supabase client: {e}")
+            logger.error("Failed to initialize Supabase client: %s", e)
             raise
 
     def insert_records(self, records: List[Dict]) -> dict:
         """
         Complete pipeline with historical archival for MULTIPLE data types:
-        1. Query existing records for BOTH data_types from updated_table
-        2. Insert those records into historical_table (archive)
-        3. Delete those records from updated_table
-        4. Insert new cleaned records into updated_table
-        5. Log the operation
+        1. Copy existing records for BOTH data_types from updated_table into historical_table
+        2. Delete those records from updated_table
+        3. Insert new cleaned records into updated_table
+           (1-2 and the first batch commit together in the archive_and_replace RPC;
+           remaining batches are inserted concurrently after it and commit on their own,
+           so a batch that still fails after retries leaves a partial load behind.
+           With SUPABASE_DB_URL set, everything is loaded with COPY in one transaction)
+        4. Log the operation (written by the same transaction when it carries the whole
+           load, otherwise from here once every batch is in)
         
         Returns: Summary of insertion results
         """
@@ -57,78 +192,69 @@ class SupabaseHandler:
                 "records_deleted": 0
             }
         
-        logger.info(f"🚀 Starting pipeline for '{self.script_name}'...")
-        logger.info(f"   Processing {len(records)} new records")
-        logger.info(f"   Target data_types: {self.data_types}")
+        logger.info("🚀 Starting pipeline for '%s'...", self.script_name)
+        logger.info("   Processing %s new records", len(records))
+        logger.info("   Target data_types: %s", self.data_types)
+        
+        # The source sheet can repeat a CPT code; keep the last row per (data_type, code)
+        unique_records = {(r.get('data_type'), r.get('code')): r for r in records}
+        if len(unique_records) < len(records):
+            logger.warning("⚠️ Dropped %s duplicate (data_type, code) records", len(records) - len(unique_records))
+            records = list(unique_records.values())
         
         try:
-            # ===== STEP 1: Query existing records for BOTH data_types =====
-            logger.info(f"📥 STEP 1: Querying existing records for data_types: {self.data_types}...")
-            
-            # Query using .in_() for multiple values
-            existing_response = self.client.table(self.updated_table)\
-                .select("*")\
-                .in_("data_type", self.data_types)\
-                .execute()
+            # ===== STEPS 1-3: Archive, delete and insert =====
+            records_to_insert = len(records)
+            logger.info("🔁 STEPS 1-3: Archiving existing records and inserting %s new records...", records_to_insert)
             
-            existing_records = existing_response.data
-            records_to_archive = len(existing_records)
+            # Log sample record for debugging
+            logger.info("   Sample record: %s", records[0])
             
-            # Count by data_type for logging
-            facility_count = sum(1 for r in existing_records if r.get('data_type') == 'Facility PIP')
-            physician_count = sum(1 for r in existing_records if r.get('data_type') == 'Physician PIP')
+            use_copy = bool(SUPABASE_DB_URL) and psycopg2 is not None
+            if use_copy:
+                # Archive and COPY every record in one transaction on a direct connection
+                result = self._archive_and_copy(records)
+            else:
+                # Runs server-side, so existing rows never cross the wire; the archive,
+                # delete and first batch commit together, so the table is never left
+                # empty or half-archived. Later batches commit separately (see below)
+                params = {"p_data_types": self.data_types, "p_new": records[:BATCH_SIZE]}
+                if records_to_insert <= BATCH_SIZE:
+                    # The RPC carries the whole load, so it can commit the success row too
+                    params.update(p_script=self.script_name, p_total=records_to_insert,
+                                  p_stamp=self._log_timestamp())
+                result = retry_db(lambda: self.client.rpc("archive_and_replace", params).execute()).data
             
-            logger.info(f"   Found {records_to_archive} existing records total:")
-            logger.info(f"      - Facility PIP: {facility_count}")
-            logger.info(f"      - Physician PIP: {physician_count}")
+            records_to_archive = result["archived"]
+            archived_by_type = result["archived_by_type"]
             
-            # ===== STEP 2: Archive existing records to historical_table =====
             if records_to_archive > 0:
-                logger.info(f"📦 STEP 2: Archiving {records_to_archive} records to historical table...")
-                
-                # Remove 'id' field before inserting (let historical table generate new IDs)
-                records_for_history = []
-                for record in existing_records:
-                    historical_record = {k: v for k, v in record.items() if k != 'id'}
-                    records_for_history.append(historical_record)
-                
-                self.client.table(self.historical_table).insert(records_for_history).execute()
-                logger.info(f"   ✅ Archived {records_to_archive} records to historical table")
+                logger.info("   ✅ Archived %s records to historical table:", records_to_archive)
+                logger.info("      - Facility PIP: %s", archived_by_type.get('Facility PIP', 0))
+                logger.info("      - Physician PIP: %s", archived_by_type.get('Physician PIP', 0))
             else:
                 logger.info("   ℹ️ No existing records to archive (first run or fresh data)")
             
-            # ===== STEP 3: Delete old records from updated_table =====
-            if records_to_archive > 0:
-                logger.info(f"🗑️ STEP 3: Deleting {records_to_archive} old records from updated table...")
-                
-                # Delete using .in_() for multiple data_types
-                self.client.table(self.updated_table)\
-                    .delete()\
-                    .in_("data_type", self.data_types)\
-                    .execute()
-                
-                logger.info(f"   ✅ Deleted {records_to_archive} old records")
-            
-            # ===== STEP 4: Insert new records into updated_table =====
-            records_to_insert = len(records)
-            logger.info(f"📤 STEP 4: Inserting {records_to_insert} new records into updated table...")
-            
-            # Log sample record for debugging
-            logger.info(f"   Sample record: {records[0]}")
+            if not use_copy:
+                # The first batch went in with the RPC; the rest follow as concurrent batches,
+                # each retried on transient errors since the archive has already committed
+                self._insert_batches(self.updated_table, records[BATCH_SIZE:])
             
-            response = self.client.table(self.updated_table).insert(records).execute()
+            # Count by data_type for new records in a single pass
+            new_by_type = Counter(r.get('data_type') for r in records)
             
-            # Count by data_type for new records
-            new_facility_count = sum(1 for r in records if r.get('data_type') == 'Facility PIP')
-            new_physician_count = sum(1 for r in records if r.get('data_type') == 'Physician PIP')
+            logger.info("   ✅ Successfully inserted %s new records:", records_to_insert)
+            logger.info("      - Facility PIP: %s", new_by_type.get('Facility PIP', 0))
+            logger.info("      - Physician PIP: %s", new_by_type.get('Physician PIP', 0))
             
-            logger.info(f"   ✅ Successfully inserted {records_to_insert} new records:")
-            logger.info(f"      - Facility PIP: {new_facility_count}")
-            logger.info(f"      - Physician PIP: {new_physician_count}")
-            
-            # ===== STEP 5: Log the operation =====
-            log_message = self._create_log_message(records_to_archive, records_to_insert)
-            self._log_operation(log_message)
+            # ===== STEP 4: Log the operation =====
+            if result.get("log_message"):
+                # Already written to logging_table by archive_and_replace
+                logger.info("✅ Logged to database: %s", result["log_message"])
+            else:
+                # Only log success once the last batch is in
+                log_message = self._create_log_message(records_to_archive, records_to_insert)
+                self._log_operation(log_message)
             
             # ===== Return summary =====
             return {
@@ -142,9 +268,9 @@ class SupabaseHandler:
             
         except APIError as e:
             error_message = f"Failed to process {self.script_name}: API Error - {e.message}"
-            logger.error(f"❌ {error_message}")
-            logger.error(f"    Details: {e.details}")
-            logger.error(f"    Hint: {e.hint}")
+            logger.error("❌ %s", error_message)
+            logger.error("    Details: %s", e.details)
+            logger.error("    Hint: %s", e.hint)
             
             # Log the failure
             self._log_operation(error_message, success=False)
@@ -152,16 +278,65 @@ class SupabaseHandler:
             raise
         except Exception as e:
             error_message = f"Failed to process {self.script_name}: {str(e)}"
-            logger.error(f"❌ {error_message}")
+            logger.error("❌ %s", error_message)
             
             # Log the failure
             self._log_operation(error_message, success=False)
             
             raise Exception(error_message)
     
+    def _insert_batches(self, table: str, records: List[Dict]) -> int:
+        """Insert records into `table` in concurrent batches, returning the number of rows sent"""
+        def insert_batch(batch: List[Dict]) -> int:
+            # return=minimal: PostgREST doesn't echo the inserted rows back
+            retry_db(lambda: self.client.table(table).insert(batch, returning=ReturnMethod.minimal).execute())
+            return len(batch)
+
+        with ThreadPoolExecutor(max_workers=INSERT_CONCURRENCY) as executor:
+            futures = [executor.submit(insert_batch, batch) for batch in _chunked(records, BATCH_SIZE)]
+            try:
+                return sum(future.result() for future in as_completed(futures))
+            except Exception:
+                # Don't start batches still waiting in the queue once one has failed
+                for future in futures:
+                    future.cancel()
+                raise
+    
+    def _archive_and_copy(self, records: List[Dict]) -> dict:
+        """
+        Archive existing rows and bulk-load `records` with COPY in a single transaction.
+        archive_and_replace is called with no rows so it still archives and writes the
+        success log; returns its result.
+        """
+        columns = list(records[0].keys())
+        buffer = io.StringIO()
+        for record in records:
+            buffer.write("\t".join(_copy_value(record.get(c)) for c in columns))
+            buffer.write("\n")
+        buffer.seek(0)
+
+        copy_sql = sql.SQL("COPY {} ({}) FROM STDIN").format(
+            sql.Identifier(self.updated_table),
+            sql.SQL(", ").join(map(sql.Identifier, columns))
+        )
+
+        conn = psycopg2.connect(SUPABASE_DB_URL)
+        try:
+            # Commits on success, rolls back archive and load together on error
+            with conn, conn.cursor() as cur:
+                cur.execute(
+                    "SELECT public.archive_and_replace(%s, '[]'::jsonb, %s, %s, %s)",
+                    (self.data_types, self.script_name, len(records), self._log_timestamp())
+                )
+                result = cur.fetchone()[0]
+                cur.copy_expert(copy_sql, buffer)
+        finally:
+            conn.close()
+        return result
+    
     def _create_log_message(self, archived_count: int, inserted_count: int) -> str:
-        """Create a human-readable log message"""
-        timestamp = datetime.now().strftime("%B %d, %Y at %I:%M %p")
+        """Create a human-readable log message (same wording archive_and_replace uses)"""
+        timestamp = self._log_timestamp()
         
         if archived_count > 0:
             message = (f"{self.script_name}: Archived {archived_count:,} old records "
@@ -172,19 +347,29 @@ class SupabaseHandler:
         
         return message
     
+    def _log_timestamp(self) -> str:
+        """Timestamp embedded in the success log message"""
+        # Same text as strftime("%B %d, %Y at %I:%M %p") without the locale lookup
+        now = datetime.now()
+        return f"{_MONTHS[now.month - 1]} {now.day:02d}, {now.year} at {now.strftime('%I:%M %p')}"
+    
     def _log_operation(self, message: str, success: bool = True):
-        """Log operation to logging_table"""
+        """Log operation to logging_table in the background"""
+        self._log_pool.submit(self._do_log, message, success)
+    
+    def _do_log(self, message: str, success: bool = True):
+        """Write one row to logging_table"""
         try:
             log_entry = {
                 "message": message,
                 "script": self.script_name
             }
             
-            self.client.table(self.logging_table).insert(log_entry).execute()
+            retry_db(lambda: self.client.table(self.logging_table).insert(log_entry, returning=ReturnMethod.minimal).execute())
             
             status = "✅" if success else "❌"
-            logger.info(f"{status} Logged to database: {message}")
+            logger.info("%s Logged to database: %s", status, message)
             
         except Exception as e:
-            logger.error(f"⚠️ Failed to write log entry: {e}")
+            logger.error("⚠️ Failed to write log entry: %s", e)
             # Don't raise - logging failure shouldn't break the pipeline
\ No newline at end of file
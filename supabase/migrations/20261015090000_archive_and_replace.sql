@@ -0,0 +1,124 @@
+-- Archive every row of the given data_types into the history table, remove
+-- them from the working table and load the replacement rows, all inside the
+-- single transaction of the calling PostgREST request.
+--
+-- Called by the scraper pipelines as:
+--   rpc("archive_and_replace", {"p_data_types": [...], "p_new": [...]})
+
+-- Column list shared by the working and history tables, minus id, so archived
+-- rows get fresh ids from the history table
+CREATE OR REPLACE FUNCTION public.history_columns()
+RETURNS text
+LANGUAGE sql
+STABLE
+AS $$
+    SELECT string_agg(quote_ident(h.column_name), ', ' ORDER BY h.ordinal_position)
+      FROM information_schema.columns h
+      JOIN information_schema.columns u
+        ON u.table_schema = h.table_schema
+       AND u.table_name = 'updated_medical_benchmarking_data'
+       AND u.column_name = h.column_name
+     WHERE h.table_schema = 'public'
+       AND h.table_name = 'historical_medical_benchmarking_data'
+       AND h.column_name <> 'id';
+$$;
+
+-- Move the working rows of the given data_types into the history table: the
+-- DELETE ... RETURNING feeds the archive insert directly, so the rows are
+-- scanned once and never leave the database.
+-- Returns {"<data_type>": <rows moved>, ...}
+CREATE OR REPLACE FUNCTION public.archive_and_delete_rows(p_types text[])
+RETURNS jsonb
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_counts jsonb;
+BEGIN
+    EXECUTE format(
+        'WITH moved AS (
+             DELETE FROM public.updated_medical_benchmarking_data
+              WHERE data_type = ANY($1)
+          RETURNING *
+         ), archived AS (
+             INSERT INTO public.historical_medical_benchmarking_data (%1$s)
+             SELECT %1$s FROM moved
+             RETURNING data_type
+         )
+         SELECT coalesce(jsonb_object_agg(data_type, n), ''{}''::jsonb)
+           FROM (SELECT data_type, count(*) AS n FROM archived GROUP BY data_type) c',
+        public.history_columns())
+    INTO v_counts
+    USING p_types;
+
+    RETURN v_counts;
+END;
+$$;
+
+-- Returns {"archived": n, "archived_by_type": {...}, "inserted": n, "log_message": text|null}
+-- When p_script is given, logs "<script>: Archived ... and inserted <p_total> ..."
+-- using p_total (the run's full insert count) and the caller's p_stamp. Only pass
+-- p_script when this call completes the load (p_new holds every row, or the rest
+-- is loaded in the same transaction); otherwise log after the last batch commits
+CREATE OR REPLACE FUNCTION public.archive_and_replace(
+    p_data_types text[],
+    p_new jsonb,
+    p_script text DEFAULT NULL,
+    p_total bigint DEFAULT NULL,
+    p_stamp text DEFAULT NULL
+)
+RETURNS jsonb
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_new_cols text;
+    v_archived_by_type jsonb;
+    v_archived bigint;
+    v_inserted bigint := 0;
+    v_message text;
+BEGIN
+    v_archived_by_type := public.archive_and_delete_rows(p_data_types);
+    SELECT coalesce(sum(value::bigint), 0)
+      INTO v_archived
+      FROM jsonb_each_text(v_archived_by_type);
+
+    IF jsonb_array_length(p_new) > 0 THEN
+        -- Insert only the keys the client sent so column defaults still apply
+        SELECT string_agg(quote_ident(k), ', ')
+          INTO v_new_cols
+          FROM jsonb_object_keys(p_new -> 0) AS k;
+
+        EXECUTE format(
+            'INSERT INTO public.updated_medical_benchmarking_data (%1$s)
+             SELECT %1$s
+               FROM jsonb_populate_recordset(NULL::public.updated_medical_benchmarking_data, $1)',
+            v_new_cols)
+        USING p_new;
+        GET DIAGNOSTICS v_inserted = ROW_COUNT;
+    END IF;
+
+    IF p_script IS NOT NULL THEN
+        IF v_archived > 0 THEN
+            v_message := format('%s: Archived %s old records and inserted %s new records (%s)',
+                                p_script,
+                                to_char(v_archived, 'FM999,999,999,999'),
+                                to_char(coalesce(p_total, v_inserted), 'FM999,999,999,999'),
+                                p_stamp);
+        ELSE
+            v_message := format('%s: Inserted %s new records (%s)',
+                                p_script,
+                                to_char(coalesce(p_total, v_inserted), 'FM999,999,999,999'),
+                                p_stamp);
+        END IF;
+
+        INSERT INTO public.logging_table (message, script)
+        VALUES (v_message, p_script);
+    END IF;
+
+    RETURN jsonb_build_object(
+        'archived', v_archived,
+        'archived_by_type', v_archived_by_type,
+        'inserted', v_inserted,
+        'log_message', v_message
+    );
+END;
+$$;
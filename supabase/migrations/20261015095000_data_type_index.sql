@@ -0,0 +1,10 @@
+-- archive_and_delete_rows deletes by data_type = ANY(...) on every run; without
+-- an index that DELETE scans the whole table. A plain (not partial) index also
+-- serves the Fair Health, CLFS and ASC scripts that share the table.
+CREATE INDEX IF NOT EXISTS updated_medical_benchmarking_data_data_type_idx
+    ON public.updated_medical_benchmarking_data (data_type);
+
+-- History is only ever appended to by the pipeline, but reports read it per
+-- data_type
+CREATE INDEX IF NOT EXISTS historical_medical_benchmarking_data_data_type_idx
+    ON public.historical_medical_benchmarking_data (data_type);